@@ -1,45 +1,877 @@
+############################################
+#  共通設定（HTTP並列取得用）
+############################################
+import atexit
+import gc
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import gspread
+import requests
+from google import genai
+from google.genai import errors as genai_errors
+from oauth2client.service_account import ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import html as lxml_html
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+from webdriver_manager.chrome import ChromeDriverManager
+
+# orjson（Rust実装）があればJSONパースに使う。未導入環境はstdlibで動く
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Yahoo側にブラウザアクセスとして扱わせるためのUA
+REQ_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+    )
+}
+
+# 接続先はnews.yahoo.co.jpのみなので、Sessionでkeep-alive接続を
+# 使い回してTLSハンドシェイクを1回に抑える（並列ワーカー数分プールする）。
+# 一時的な429/5xxはアダプタ側のRetryが指数バックオフ付きで面倒を見る
+SESSION = requests.Session()
+SESSION.headers.update(REQ_HEADERS)
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=(429, 500, 502, 503, 504),
+        ),
+    ),
+)
+
+# 本文ページ取得はネットワーク待ちが支配的なのでスレッドプールで並列化する
+EXECUTOR = ThreadPoolExecutor(max_workers=12)
+
+# 記事（行）単位の並列取得ワーカー数。ページ取得はEXECUTOR側で行うため、
+# 同じプールを使うとワーカー枯渇でデッドロックし得る → 行用は別プールにする
+ROW_WORKERS = 4
+
+# Yahooニュース記事URLの判定用（ループ内で毎回コンパイルしないよう事前コンパイル）
+ARTICLE_URL_RE = re.compile(r"https://news\.yahoo\.co\.jp/articles/[A-Za-z0-9]+")
+
+# Gemini入力の空白正規化用。連続空白・改行を1スペースに潰してトークンを節約する
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+# 本文ページの最大数（E〜N列の10セルに対応）
+MAX_BODY_PAGES = 10
+
+# E〜N書き込み時のパディング用。行ごとに [""] * n を作り直さず、
+# この定数のスライスで埋める
+EMPTY_PAGE_ROW = [""] * MAX_BODY_PAGES
+
+# シートの列レイアウト（E〜N: 本文ページ、O: コメント数、P〜R: Gemini結果）。
+# 範囲文字列はループ内で組み立て直さずテンプレートとして事前定義しておく
+BODY_RANGE_TMPL = "E{row}:N{row}"
+BODY_HEAD_CELL_TMPL = "E{row}"
+COMMENT_CELL_TMPL = "O{row}"
+AI_RANGE_TMPL = "P{row}:R{row}"
+AI_HEAD_CELL_TMPL = "P{row}"
+
+
+############################################
+#  APIレート制限（トークンバケット方式）
+############################################
+class RateLimiter:
+    """
+    トークンバケット方式のレートリミッタ。
+    固定sleepと違い、クォータに余裕がある間は待たずに進み、
+    バースト時だけ必要な分だけブロックする。
+    """
+
+    def __init__(self, rate_per_sec, burst=1):
+        self.rate = rate_per_sec
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """トークンが1つ貯まるまでブロックして消費する。"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    float(self.burst),
+                    self._tokens + (now - self._last) * self.rate,
+                )
+                self._last = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Sheetsの書き込みクォータ（60回/分）とGeminiのRPM上限に合わせた設定
+SHEETS_LIMITER = RateLimiter(1.0, burst=4)
+GEMINI_LIMITER = RateLimiter(0.25, burst=1)
+
+
+############################################
+#  スプレッドシート接続（ハンドルはキャッシュ）
+############################################
+SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID", "")
+SHEET_NAME = os.environ.get("SHEET_NAME", "Yahoo!")
+
+GSPREAD_SCOPES = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/drive",
+]
+
+# 認可済みクライアントと解決済みWorksheetはAPI往復を伴うため、
+# 一度作ったものをキャッシュして各処理ステップで使い回す
+_GSPREAD_CLIENT = None
+_WS_CACHE = {}
+
+
+def get_gspread_client():
+    """認可済みgspreadクライアントを返す（初回のみ認証）。"""
+    global _GSPREAD_CLIENT
+    if _GSPREAD_CLIENT is None:
+        creds_str = os.environ["GCP_SERVICE_ACCOUNT_KEY"]
+        if orjson is not None:
+            creds_dict = orjson.loads(creds_str)
+        else:
+            creds_dict = json.loads(creds_str)
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(
+            creds_dict, GSPREAD_SCOPES
+        )
+        _GSPREAD_CLIENT = gspread.authorize(creds)
+    return _GSPREAD_CLIENT
+
+
+def get_worksheet(sheet_name=SHEET_NAME):
+    """ワークシートのハンドルを返す（初回のみAPI解決、以降はキャッシュ）。"""
+    if not SPREADSHEET_ID:
+        # 未設定のままopen_by_key("")でAPIエラーになるより先に止める
+        raise RuntimeError("環境変数 SPREADSHEET_ID が設定されていません")
+    if sheet_name not in _WS_CACHE:
+        gc = get_gspread_client()
+        _WS_CACHE[sheet_name] = gc.open_by_key(SPREADSHEET_ID).worksheet(sheet_name)
+    return _WS_CACHE[sheet_name]
+
+
+############################################
+#  Seleniumドライバ（プロセスで1本を使い回す）
+############################################
+# 起動1回あたり1〜2秒＋数百MBかかるため、都度起動せず
+# 遅延初期化したシングルトンを全記事で使い回す。
+# Selenium自体はスレッドセーフではないため、生成だけでなく
+# ナビゲーション〜抽出までの一連の操作をロックで直列化する
+# （再入するためRLock）。
+_DRIVER = None
+_DRIVER_LOCK = threading.RLock()
+_DRIVER_USES = 0
+
+# 長寿命ChromeはDOMキャッシュ・JSヒープでメモリが単調増加するため、
+# この回数使ったら一度quitして作り直す（メモリ上限を一定に保つ）
+DRIVER_RECYCLE_AFTER = 50
+
+
+def _quit_driver():
+    """現在のドライバを終了して破棄する（未起動なら何もしない）。"""
+    global _DRIVER
+    with _DRIVER_LOCK:
+        if _DRIVER is not None:
+            try:
+                _DRIVER.quit()
+            except Exception:
+                pass
+            _DRIVER = None
+
+
+atexit.register(_quit_driver)
+
+
+def get_driver():
+    """ヘッドレスChromeを返す（初回のみ起動、一定回数使用後に作り直し）。"""
+    global _DRIVER, _DRIVER_USES
+    with _DRIVER_LOCK:
+        # 使用回数が上限に達したら作り直す（溜まったヒープはGCで回収）
+        if _DRIVER is not None and _DRIVER_USES >= DRIVER_RECYCLE_AFTER:
+            _quit_driver()
+            gc.collect()
+        if _DRIVER is None:
+            _DRIVER_USES = 0
+            options = Options()
+            options.add_argument("--headless=new")
+            options.add_argument("--no-sandbox")
+            options.add_argument("--disable-gpu")
+            options.add_argument(f"user-agent={REQ_HEADERS['User-Agent']}")
+            # DOMContentLoadedで制御を返す（本文<p>の出現はWebDriverWaitで待つ）
+            options.page_load_strategy = "eager"
+            # 本文抽出に画像・CSS・フォントは不要なので読み込み自体を止める
+            options.add_experimental_option(
+                "prefs",
+                {
+                    "profile.managed_default_content_settings.images": 2,
+                    "profile.managed_default_content_settings.stylesheets": 2,
+                    "profile.managed_default_content_settings.fonts": 2,
+                },
+            )
+            _DRIVER = webdriver.Chrome(
+                service=Service(ChromeDriverManager().install()),
+                options=options,
+            )
+        _DRIVER_USES += 1
+        return _DRIVER
+
+
+############################################
+#  Gemini解析
+############################################
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.0-flash")
+
+# 役割→企業特定→カテゴリ→ポジネガの順に連結して1プロンプトにする
+PROMPT_FILES = [
+    "prompt_gemini_role.txt",
+    "prompt_target_company.txt",
+    "prompt_category.txt",
+    "prompt_posinega.txt",
+]
+
+# 429（クォータ超過）時の指数バックオフ設定
+GEMINI_MAX_ATTEMPTS = 8
+GEMINI_BACKOFF_BASE = 30
+GEMINI_BACKOFF_CAP = 300
+
+# Gemini呼び出しの並列ワーカー数（レートリミッタでRPMは別途制御）
+GEMINI_WORKERS = 4
+
+# Gemini判定に渡す本文の上限文字数
+MAX_AI_TEXT_CHARS = 3000
+
+# これ未満の本文は取得失敗・ペイウォール等とみなし、Geminiに投げない
+MIN_AI_TEXT_CHARS = 100
+
+# 構造化出力のスキーマ。JSONで返すようプロンプトで頼むのではなく
+# API側に形を強制させ、コードブロック除去やJSON崩れの再試行を不要にする
+GEMINI_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "company_info": {"type": "STRING"},
+        "category": {"type": "STRING"},
+        "sentiment": {"type": "STRING"},
+    },
+    "required": ["company_info", "category", "sentiment"],
+}
+
+_GEMINI_CLIENT = None
+
+
+def get_gemini_client():
+    """Geminiクライアントを返す（初回のみ生成）。"""
+    global _GEMINI_CLIENT
+    if _GEMINI_CLIENT is None:
+        _GEMINI_CLIENT = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+    return _GEMINI_CLIENT
+
+
+_GEMINI_PROMPT = None
+
+
+def load_gemini_prompt():
+    """プロンプトファイル4本を連結して返す（ディスク読みは初回の1度だけ）。"""
+    global _GEMINI_PROMPT
+    if _GEMINI_PROMPT is None:
+        parts = []
+        for path in PROMPT_FILES:
+            with open(path, encoding="utf-8") as f:
+                parts.append(f.read().strip())
+        _GEMINI_PROMPT = "\n\n".join(parts)
+    return _GEMINI_PROMPT
+
+
+def _retry_delay_seconds(e):
+    """429レスポンスのRetryInfo（"30s"形式のretryDelay）を秒数で返す。
+
+    見つからない・形式が想定外の場合は0を返す。
+    """
+    try:
+        details = (e.details or {}).get("error", {}).get("details", [])
+        for detail in details:
+            if detail.get("@type", "").endswith("RetryInfo"):
+                return float(detail.get("retryDelay", "0s").rstrip("s"))
+    except Exception:
+        pass
+    return 0.0
+
+
+def analyze_with_gemini(text):
+    """
+    記事本文をGeminiで解析し、category / sentiment / company_info を
+    持つdictを返す。429はraiseせず指数バックオフ＋ジッタで待って
+    リトライし、残りの記事の解析を中断させない。
+    """
+    prompt = f"{load_gemini_prompt()}\n\n【記事本文】\n{text}"
+    client = get_gemini_client()
+
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        try:
+            resp = client.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=prompt,
+                config={
+                    "response_mime_type": "application/json",
+                    "response_schema": GEMINI_RESPONSE_SCHEMA,
+                },
+            )
+
+            # スキーマ強制によりSDKがパース済みオブジェクトを返す
+            if isinstance(resp.parsed, dict):
+                return resp.parsed
+
+            # SDKがparsedを返さなかった場合のみテキストを自前でパース
+            raw = resp.text.strip()
+            if raw.startswith("```"):
+                raw = raw[raw.find("{"):raw.rfind("}") + 1]
+
+            if orjson is not None:
+                return orjson.loads(raw)
+            return json.loads(raw)
+
+        except genai_errors.APIError as e:
+            # google-genai SDKは429もAPIErrorで返すため、コードで分岐する
+            if getattr(e, "code", None) != 429:
+                # 5xx等のAPIエラーは下の汎用リトライと同じ短い間隔で再試行
+                if attempt >= 2:
+                    raise
+                print(f"[WARN] Gemini呼び出し失敗（リトライ）: {e}")
+                time.sleep(2 * (attempt + 1))
+                continue
+
+            # クォータ超過はサーバのretryDelay指示を優先しつつ、
+            # 指数バックオフ＋ジッタで待ってから再試行する
+            wait = min(
+                GEMINI_BACKOFF_CAP,
+                GEMINI_BACKOFF_BASE * (1.5 ** attempt),
+            ) + random.uniform(0, 5)
+            wait = max(wait, _retry_delay_seconds(e))
+            print(
+                f"[WARN] Gemini 429: {wait:.0f}秒待機してリトライ "
+                f"({attempt + 1}/{GEMINI_MAX_ATTEMPTS})"
+            )
+            time.sleep(wait)
+
+        except Exception as e:
+            # JSON崩れ等の一時エラーはクォータと違い短い間隔でリトライ
+            if attempt >= 2:
+                raise
+            print(f"[WARN] Gemini呼び出し失敗（リトライ）: {e}")
+            time.sleep(2 * (attempt + 1))
+
+    raise RuntimeError("Gemini解析が最大リトライ回数を超えました")
+
+
+# 同一本文の再解析を避けるメモ化キャッシュ（通信社配信の重複記事・再実行対策）。
+# キーは正規化済み本文の先頭2KBのハッシュ。末尾の広告差分程度ならヒットする
+_GEMINI_CACHE = {}
+_GEMINI_CACHE_LOCK = threading.Lock()
+
+
+def _gemini_cache_key(text):
+    """Geminiキャッシュのキー（本文先頭2KBのblake2bハッシュ）を返す。"""
+    return hashlib.blake2b(text[:2048].encode(), digest_size=16).digest()
+
+
+def analyze_with_gemini_limited(text):
+    """レートリミッタを挟んでanalyze_with_geminiを呼ぶ（並列ワーカー用）。
+
+    同じ本文は再解析せずキャッシュ済みの結果を返す。
+    """
+    key = _gemini_cache_key(text)
+    with _GEMINI_CACHE_LOCK:
+        if key in _GEMINI_CACHE:
+            return _GEMINI_CACHE[key]
+
+    # キャッシュミス時のみAPIを呼ぶ → レートリミッタもここで待つ
+    GEMINI_LIMITER.acquire()
+    result = analyze_with_gemini(text)
+
+    with _GEMINI_CACHE_LOCK:
+        _GEMINI_CACHE[key] = result
+    return result
+
+
+############################################
+#  投稿日時のパースと取得要否の判定
+############################################
+# 「11/14(木) 10:00」のような曜日括弧を除去してからstrptimeに渡す
+WEEKDAY_RE = re.compile(r"\([月火水木金土日]\)")
+
+# C列で見られる表記ゆれの候補フォーマット
+POST_DATE_FORMATS = [
+    "%Y/%m/%d %H:%M",
+    "%m/%d %H:%M",
+    "%Y/%m/%d",
+    "%m/%d",
+]
+
+# 同一実行内ではフォーマットはほぼ一定。直前に成功したものを先に試して
+# strptimeのValueError（例外生成が高くつく）を減らす
+_LAST_DATE_FMT = None
+
+# 投稿からこの日数以内の記事は、本文の追記・訂正を拾うため再取得する
+REFETCH_WINDOW_DAYS = 3
+
+
+def parse_post_date(date_str):
+    """C列の投稿日時文字列をdatetimeにして返す（パース不能時はNone）。"""
+    global _LAST_DATE_FMT
+
+    if not date_str:
+        return None
+
+    s = WEEKDAY_RE.sub(" ", str(date_str)).strip()
+    s = WHITESPACE_RE.sub(" ", s)
+
+    formats = POST_DATE_FORMATS
+    if _LAST_DATE_FMT in formats:
+        formats = [_LAST_DATE_FMT] + [f for f in formats if f != _LAST_DATE_FMT]
+
+    for fmt in formats:
+        try:
+            parsed = datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        # 年を持たない表記は現在の年を補う（未来になる場合は前年扱い）
+        if parsed.year == 1900:
+            parsed = parsed.replace(year=datetime.now().year)
+            if parsed > datetime.now():
+                parsed = parsed.replace(year=parsed.year - 1)
+        _LAST_DATE_FMT = fmt
+        return parsed
+
+    return None
+
+
+def should_fetch_article(existing_text, date_str):
+    """
+    本文が未取得の行はTrue。取得済みでも投稿が新しい記事は
+    本文が追記されることがあるため再取得する。
+    E列・C列の値はループ前のbatch_getで読んだものを受け取り、
+    ここでは行ごとのAPI読みを行わない。
+    """
+    if not existing_text:
+        return True
+
+    posted = parse_post_date(date_str)
+    if posted is None:
+        return False
+
+    return (datetime.now() - posted).days <= REFETCH_WINDOW_DAYS
+
+
+############################################
+#  HTML取得（ストリーミング＋サイズ上限）
+############################################
+# 1ページあたりのHTML読み込み上限。本文抽出に必要なのは先頭数百KBで、
+# 巨大なページを丸ごと読まないことで帯域とメモリを抑える
+MAX_HTML_BYTES = 2_000_000
+
+
+class _CappedResponse:
+    """上限付きで読んだレスポンスを.text/.status_codeで公開する薄いラッパ。"""
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+
+def fetch_html(url, timeout=20):
+    """HTMLをストリーミング取得し、MAX_HTML_BYTESで打ち切って返す。"""
+    res = SESSION.get(url, timeout=timeout, stream=True)
+    try:
+        content = res.raw.read(MAX_HTML_BYTES, decode_content=True)
+    finally:
+        res.close()
+
+    encoding = res.encoding or "utf-8"
+    return _CappedResponse(res.status_code, content.decode(encoding, errors="replace"))
+
+
+# 本文と見なす段落の最小文字数。写真クレジットやナビの短い断片を弾き、
+# Geminiへ渡すトークンとシート書き込み量を減らす
+MIN_PARAGRAPH_CHARS = 20
+
+
+def _collect_paragraph_texts(article_nodes):
+    """<p>ノード群から本文段落のみを集める（広告・短断片・重複を除外）。"""
+    texts = []
+    seen = set()
+    for p in article_nodes:
+        # class名が広告系（ad〜）の段落は本文ではない
+        classes = p.get("class") or ""
+        if any(cls.startswith("ad") for cls in classes.split()):
+            continue
+        text = p.text_content().strip()
+        if len(text) < MIN_PARAGRAPH_CHARS or text in seen:
+            continue
+        seen.add(text)
+        texts.append(text)
+    return texts
+
+
+############################################
+#  Yahooニュース本文1ページ取得（requests版）
+############################################
+def fetch_article_body_page(url, page_num):
+    """
+    記事本文の1ページ分をrequestsで取得してテキストを返す。
+    ページが存在しない・取得失敗の場合は空文字を返す。
+    """
+    # 1ページ目だけ?page=が存在しないことがあるため分岐
+    if page_num == 1:
+        page_url = url
+    else:
+        page_url = f"{url}?page={page_num}"
+
+    try:
+        res = fetch_html(page_url)
+        if res.status_code != 200:
+            return ""
+
+        # bs4のTagオブジェクト生成を挟まず、lxmlのXPathで直接段落を引く
+        tree = lxml_html.fromstring(res.text)
+        article_nodes = tree.xpath("//article//p")
+
+        # ページが存在しない場合はノードがほぼ無い → 空扱い
+        if not article_nodes or len(article_nodes) < 2:
+            return ""
+
+        # 広告・短断片・重複を除いた本文段落のみを連結する
+        return "\n".join(_collect_paragraph_texts(article_nodes))
+
+    except Exception as e:
+        print(f"[WARN] Page {page_num} fetch error: {e}")
+        return ""
+
+
+############################################
+#  Yahooニュース本文1ページ取得（Seleniumフォールバック版）
+############################################
+# 一時的なネットワーク断・タブクラッシュに備えた再試行回数
+SELENIUM_NAV_RETRIES = 3
+
+
+def _render_article_text(url):
+    """
+    Seleniumで記事を描画し、<article>のinnerTextを取得する。
+    一時的なWebDriverエラーは指数バックオフで再試行し、
+    本文が描画されないページは空文字を返す。
+    """
+    for attempt in range(SELENIUM_NAV_RETRIES):
+        try:
+            # 行ワーカーが複数同時にフォールバックしても操作が混ざらないよう、
+            # ドライバ操作全体をロックで保護する
+            with _DRIVER_LOCK:
+                driver = get_driver()
+                # 使い回しドライバに前の記事のCookieを持ち越さない
+                driver.delete_all_cookies()
+                driver.get(url)
+                # 固定2秒待ちをやめ、本文<p>が現れた時点で先へ進む。
+                # 速いページなら数百msで抜け、描画されないページは
+                # タイムアウトで本文なし扱いにする
+                try:
+                    WebDriverWait(driver, 4).until(
+                        EC.presence_of_all_elements_located(
+                            (By.CSS_SELECTOR, "article p")
+                        )
+                    )
+                except TimeoutException:
+                    return ""
+                # page_sourceはDOM全体をHTML文字列化してPython側で再パース
+                # する二度手間になる。テキスト抽出はブラウザ側に任せて
+                # 完成した文字列だけを受け取る
+                return driver.execute_script(
+                    "const a = document.querySelector('article');"
+                    " return a ? a.innerText : '';"
+                )
+        except WebDriverException as e:
+            if attempt >= SELENIUM_NAV_RETRIES - 1:
+                raise
+            # セッション死（タブクラッシュ・invalid session id）だと同じ
+            # インスタンスでは何度やっても失敗するため、破棄してから再試行する
+            _quit_driver()
+            wait = 0.5 * (2 ** attempt)
+            print(f"[WARN] Seleniumナビゲーション失敗（{wait}秒後に再試行）: {e}")
+            time.sleep(wait)
+
+
+def fetch_article_body_page_selenium(url):
+    """
+    requestsで本文が取れなかった場合のフォールバック。
+    Seleniumでレンダリングしてから本文を抽出する。
+    """
+    try:
+        article_text = _render_article_text(url)
+        if not article_text:
+            return ""
+
+        # innerTextは段落が改行区切りで届くため、requests版と同等の
+        # 短断片・重複フィルタを行単位で適用する
+        texts = []
+        seen = set()
+        for line in article_text.splitlines():
+            line = line.strip()
+            if len(line) < MIN_PARAGRAPH_CHARS or line in seen:
+                continue
+            seen.add(line)
+            texts.append(line)
+
+        if len(texts) < 2:
+            return ""
+
+        return "\n".join(texts)
+
+    except Exception as e:
+        print(f"[WARN] Selenium fallback fetch error: {e}")
+        return ""
+
+
+############################################
+#  コメント数取得（requests版）
+############################################
+# コメント数API。記事HTML（数百KB）を読まなくても記事IDだけで引ける
+COMMENT_API_TMPL = "https://news.yahoo.co.jp/api/comment/count?articleIds={article_id}"
+ARTICLE_ID_RE = re.compile(r"/articles/([A-Za-z0-9]+)")
+
+# フォールバック用。記事ページに埋め込まれた状態JSONからコメント数を拾う
+COMMENT_COUNT_RE = re.compile(r'"commentCount"\s*:\s*(\d+)')
+
+
+def _comment_count_from_html(url):
+    """記事HTML埋め込みJSONからコメント数を抽出する（APIのフォールバック）。"""
+    res = fetch_html(url)
+    if res.status_code != 200:
+        raise RuntimeError(f"status {res.status_code}")
+
+    m = COMMENT_COUNT_RE.search(res.text)
+    if m:
+        return int(m.group(1))
+
+    # コメント欄のない記事はカウント自体が埋め込まれない → 0件扱い
+    return 0
+
+
+# 一括取得1回あたりのarticleIds数（URL長の上限を踏まえた控えめな値）
+COMMENT_BATCH_SIZE = 50
+
+
+def fetch_comment_counts_batch(urls):
+    """
+    複数記事のコメント数をまとめて取得する。
+    コメント数APIはarticleIdsのカンマ区切り指定を受け付けるため、
+    N本のHTTPを数本に畳める。
+    Returns:
+        dict: URL→コメント数。IDが引けない・応答に現れないURLは含めず、
+              呼び出し側で行単位のfetch_comment_countにフォールバックする。
+    """
+    id_to_url = {}
+    for url in urls:
+        m = ARTICLE_ID_RE.search(url)
+        if m:
+            id_to_url[m.group(1)] = url
+
+    counts = {}
+    ids = list(id_to_url)
+    for start in range(0, len(ids), COMMENT_BATCH_SIZE):
+        chunk = ids[start:start + COMMENT_BATCH_SIZE]
+        try:
+            res = SESSION.get(
+                COMMENT_API_TMPL.format(article_id=",".join(chunk)), timeout=20
+            )
+            if res.status_code != 200:
+                continue
+            payload = orjson.loads(res.content) if orjson else res.json()
+        except Exception as e:
+            print(f"[WARN] コメント数一括取得失敗（行単位へフォールバック）: {e}")
+            continue
+        for entry in payload if isinstance(payload, list) else []:
+            article_id = entry.get("id") or entry.get("articleId")
+            if article_id in id_to_url and "count" in entry:
+                counts[id_to_url[article_id]] = int(entry["count"])
+    return counts
+
+
+def fetch_comment_count(url):
+    """
+    記事のコメント数を取得する。
+    まず記事IDでコメント数APIを叩き（JSON1件、HTML取得より1桁軽い）、
+    応答が想定外の場合のみ記事HTMLの埋め込みJSONにフォールバックする。
+    """
+    m = ARTICLE_ID_RE.search(url)
+    if m:
+        try:
+            res = SESSION.get(
+                COMMENT_API_TMPL.format(article_id=m.group(1)), timeout=20
+            )
+            if res.status_code == 200:
+                payload = orjson.loads(res.content) if orjson else res.json()
+                for entry in payload if isinstance(payload, list) else []:
+                    if "count" in entry:
+                        return int(entry["count"])
+        except Exception as e:
+            print(f"[WARN] コメント数API失敗（HTMLへフォールバック）: {e}")
+
+    return _comment_count_from_html(url)
+
+
 ############################################
 #  Yahooニュース本文（最大10ページ）取得関数
 ############################################
-def fetch_yahoo_article_pages(driver, url, max_pages=10):
+def fetch_yahoo_article_pages(url, max_pages=MAX_BODY_PAGES):
     """
     Yahooニュースの記事本文を最大10ページまで取得。
+    全ページをrequestsでスレッドプール並列取得し、1ページ目が
+    取れなかった場合のみSelenium（JS描画）でフォールバックする。
     Returns:
         pages_text: list[str]   # 各ページ本文
         combined_text: str      # 全ページ連結（Gemini判定用）
     """
+    # --- 全ページをrequestsで並列取得 ---
+    futures = [
+        EXECUTOR.submit(fetch_article_body_page, url, page_num)
+        for page_num in range(1, max_pages + 1)
+    ]
+
+    # 1ページ目が空＝JS描画が必要な記事とみなしてSeleniumで再取得
+    first_page = futures[0].result()
+    if not first_page:
+        first_page = fetch_article_body_page_selenium(url)
+
+    # ページ順を維持しつつ、最初の空ページで打ち切る。
+    # Yahooは実ページ数を超える?page=Nに1ページ目を返すことがあるため、
+    # 本文ハッシュの重複も打ち切り条件にする（重複本文を格納しない）。
+    # 打ち切り後の残ページは結果を待たずにキャンセルする
     pages_text = []
+    seen_hashes = set()
+    stopped = not first_page
+    if first_page:
+        pages_text.append(first_page)
+        seen_hashes.add(
+            hashlib.blake2b(first_page.encode(), digest_size=8).digest()
+        )
 
-    for page_num in range(1, max_pages + 1):
-        # 1ページ目だけ?page=が存在しないことがあるため例外処理
-        if page_num == 1:
-            page_url = url
-        else:
-            page_url = f"{url}?page={page_num}"
+    for future in futures[1:]:
+        if stopped:
+            future.cancel()
+            continue
+        page_text = future.result()
+        if not page_text:
+            stopped = True
+            continue
+        page_hash = hashlib.blake2b(page_text.encode(), digest_size=8).digest()
+        if page_hash in seen_hashes:
+            stopped = True
+            continue
+        seen_hashes.add(page_hash)
+        pages_text.append(page_text)
 
-        try:
-            driver.get(page_url)
-            time.sleep(2)
+    combined_text = "\n".join(pages_text)
+    return pages_text, combined_text
 
-            soup = BeautifulSoup(driver.page_source, "html.parser")
 
-            # 本文ノード（Yahooの通常記事構造に準拠）
-            article_nodes = soup.select("article p")
+############################################
+#  ローカルチェックポイント（クラッシュ時の再取得防止）
+############################################
+# シートへの書き込みはフェーズ末尾のbatch_updateまで遅延されるため、
+# 途中で落ちるとそのフェーズで取得した本文がすべて失われる。
+# 行単位の取得結果をJSON Linesで逐次追記しておき、再実行時は
+# ここにあるURLの本文をHTTPを介さずに再利用する
+CHECKPOINT_PATH = os.environ.get("CHECKPOINT_PATH", "checkpoint.jsonl")
+
+# これより古いチェックポイントは追記・更新の可能性があるため使わない
+CHECKPOINT_TTL_SECONDS = 24 * 3600
 
-            # ページが存在しない場合はノードがほぼ無い → break
-            if not article_nodes or len(article_nodes) < 2:
-                break
+_CHECKPOINT_LOCK = threading.Lock()
 
-            # 改行付きでテキスト抽出
-            page_text = "\n".join([p.get_text(strip=True) for p in article_nodes])
-            pages_text.append(page_text)
 
-        except Exception as e:
-            print(f"[WARN] Page {page_num} fetch error: {e}")
-            break
+def load_checkpoint():
+    """チェックポイントを読み、URL→pages_textの辞書を返す（同一URLは最後勝ち）。"""
+    records = {}
+    if not os.path.exists(CHECKPOINT_PATH):
+        return records
 
-    combined_text = "\n".join(pages_text)
-    return pages_text, combined_text
+    now = time.time()
+    with open(CHECKPOINT_PATH, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = orjson.loads(line) if orjson else json.loads(line)
+            except ValueError:
+                # 書き込み途中でクラッシュした末尾の欠け行などは捨てる
+                continue
+            if now - rec.get("ts", 0) > CHECKPOINT_TTL_SECONDS:
+                continue
+            records[rec.get("url", "")] = rec.get("pages_text", [])
+    return records
+
+
+def clear_checkpoint():
+    """シート反映済みのチェックポイントを破棄する。"""
+    with _CHECKPOINT_LOCK:
+        if os.path.exists(CHECKPOINT_PATH):
+            os.remove(CHECKPOINT_PATH)
+
+
+def append_checkpoint(url, pages_text):
+    """1行ぶんの取得結果をチェックポイントへ追記する。"""
+    rec = {"url": url, "pages_text": pages_text, "ts": time.time()}
+    if orjson:
+        line = orjson.dumps(rec).decode()
+    else:
+        line = json.dumps(rec, ensure_ascii=False)
+    with _CHECKPOINT_LOCK:
+        with open(CHECKPOINT_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+# 前回実行（クラッシュ含む）の取得結果。fetch_row_detailsが参照する
+_CHECKPOINT_PAGES = load_checkpoint()
+
+
+def fetch_row_details(idx, url, use_checkpoint=True):
+    """1記事ぶんの本文取得を行うワーカー。(行番号, pages_text) を返す。
+
+    use_checkpoint=Falseの行（追記を拾うための再取得）はキャッシュを
+    使わず必ずHTTPで取り直す。
+    """
+    if use_checkpoint:
+        cached = _CHECKPOINT_PAGES.get(url)
+        if cached:
+            # 前回実行で取得済み（シート反映前に落ちた分）→ HTTPを介さず再利用
+            return idx, cached
+    pages_text, _combined = fetch_yahoo_article_pages(url)
+    if pages_text:
+        append_checkpoint(url, pages_text)
+    return idx, pages_text
 
 
 
@@ -51,9 +883,34 @@ def fetch_yahoo_article_pages(driver, url, max_pages=10):
 #  本文・コメント数取得処理
 # ==========================
 
-# すでにValuesで A〜D列を取得済みとして、row_index などは既存ロジックを維持
+# ワークシートはキャッシュ済みハンドルを取得（再オープンしない）
+sheet = get_worksheet()
+
+# 必要な3範囲（A〜D: 行データ、E: 取得済み本文、P〜R: 解析結果）を
+# 1回のbatch_getでまとめて読む。読みの往復はここで1回だけになる
+values, existing_e, existing_ai = sheet.batch_get(["A2:D", "E2:E", "P2:R"])
+
+# Gemini解析に回す（行番号, 本文）のリスト。取得フェーズで溜めて後段で並列解析する
+analysis_targets = []
+
+# 正規URL→最初に出現した行番号。同一記事が複数行にあっても取得・解析は1回で済ませる
+url_to_row = {}
+
+# 本文を取得する行（行番号, URL）。まず行を走査して振り分けだけ行い、
+# 実際のHTTP取得は後段でワーカープールに投げる
+fetch_targets = []
+
+# コメント数取得の対象（記事URLを持つ全行）
+valid_rows = []
+
+# 既にP〜R列が埋まっている（解析済み）行の集合
+analyzed_rows = set()
+
 for idx, row in enumerate(values, start=2):
 
+    # getは行末の空セルを省いて返すため4列に揃える
+    row = row + [""] * (4 - len(row))
+
     title = row[0]
     url = row[1]
     date_str = row[2]
@@ -61,61 +918,201 @@ for idx, row in enumerate(values, start=2):
 
     print(f"▶ 記事処理中: {title}")
 
-    # 本文未取得 または 日付の条件 OK の場合のみ実行
-    if should_fetch_article(url, sheet, idx):
+    # セル内からYahooニュース記事URLを正規表現だけで抽出する。
+    # クエリ文字列やメモ書きが混ざったセルでも正規URLに揃えられる。
+    url_match = ARTICLE_URL_RE.search(url or "")
+    if not url_match:
+        # 記事URLを含まない行（空行・外部リンク等）は処理しない
+        print(f"[WARN] 記事URL形式ではないためスキップ: {url}")
+        continue
+    url = url_match.group(0)
+
+    # 既に同じ記事URLを処理済みの行があればスキップ（O(1)のdict参照）
+    if url in url_to_row:
+        print(f"[WARN] 行{url_to_row[url]}と同一URLのためスキップ: {url}")
+        continue
+    url_to_row[url] = idx
+    valid_rows.append((idx, url))
+
+    # P〜R列が埋まっている行は解析済み → Gemini対象から除外
+    ai_row = existing_ai[idx - 2] if idx - 2 < len(existing_ai) else []
+    if any(cell.strip() for cell in ai_row if cell):
+        analyzed_rows.add(idx)
+
+    # E列は事前にbatch_getした値を参照（ジャグ配列なので長さを正規化）
+    e_row = existing_e[idx - 2] if idx - 2 < len(existing_e) else []
+    existing_text = e_row[0] if e_row else ""
+
+    # 本文未取得 または 日付の条件 OK の場合のみ取得対象に積む。
+    # E列が埋まっている行の再取得は「追記を拾う」ためのものなので、
+    # チェックポイントの古い本文は使わせない（第3要素で伝える）
+    if should_fetch_article(existing_text, date_str):
+        fetch_targets.append((idx, url, not existing_text))
+    elif idx not in analyzed_rows:
+        # 既に本文あり → 再取得せず、その本文を解析に回す
+        if existing_text:
+            full_text_for_ai = WHITESPACE_RE.sub(" ", existing_text).strip()[:MAX_AI_TEXT_CHARS]
+        else:
+            full_text_for_ai = ""
+        analysis_targets.append((idx, full_text_for_ai))
+
+# ============================
+#      本文取得（記事単位で並列）
+# ============================
+
+# 記事間に依存は無いので、行ごとの取得をワーカープールへ展開する。
+# ページ単位の並列（EXECUTOR）と合わせて二段の並列になる
+# E〜N列の書き込みは行ごとに送らず、取得フェーズ完了後に1回で送る
+body_updates = []
 
+with ThreadPoolExecutor(max_workers=ROW_WORKERS) as row_pool:
+    future_to_row = {
+        row_pool.submit(fetch_row_details, row_idx, row_url, use_cp): row_idx
+        for row_idx, row_url, use_cp in fetch_targets
+    }
+
+    for future in as_completed(future_to_row):
+        row_idx = future_to_row[future]
         try:
-            # ★ Yahooニュース本文を最大10ページ取得
-            pages_text, combined_text = fetch_yahoo_article_pages(driver, url)
+            row_idx, pages_text = future.result()
 
-            # --- 1ページ1セルで書き込み（E〜N列を利用） ---
-            page_columns = ['E','F','G','H','I','J','K','L','M','N']
+            # --- E〜N列（最大10ページ）をバッファに積む ---
+            pages = pages_text[:MAX_BODY_PAGES]
+            page_row = pages + EMPTY_PAGE_ROW[len(pages):]
+            body_updates.append(
+                {"range": BODY_RANGE_TMPL.format(row=row_idx), "values": [page_row]}
+            )
 
-            for i, page_content in enumerate(pages_text):
-                if i < len(page_columns):
-                    sheet.update(f"{page_columns[i]}{idx}", [[page_content]])
+            # ★ Gemini判定用の本文は上限3,000文字。全ページを連結してから
+            #    切り詰めるのではなく、上限に達した時点で連結を打ち切る
+            ai_text_parts = []
+            ai_text_len = 0
+            for page_text in pages_text:
+                ai_text_parts.append(page_text)
+                ai_text_len += len(page_text) + 1
+                if ai_text_len >= MAX_AI_TEXT_CHARS:
+                    break
+            # 空白類を潰してから上限で切る（同じ文字数により多くの本文が入る）
+            full_text_for_ai = WHITESPACE_RE.sub(
+                " ", "\n".join(ai_text_parts)
+            ).strip()[:MAX_AI_TEXT_CHARS]
 
-            # ★ 全ページを結合した本文（combined_text）で判定
-            full_text_for_ai = combined_text
+            # 解析済みの行は本文だけ更新してGeminiには回さない
+            if row_idx not in analyzed_rows:
+                analysis_targets.append((row_idx, full_text_for_ai))
 
         except Exception as e:
-            print(f"[ERROR] 本文取得中にエラー: {e}")
-            sheet.update(f"E{idx}", [[f"本文取得エラー: {e}"]])
+            print(f"[ERROR] 本文取得中にエラー (row {row_idx}): {e}")
+            body_updates.append(
+                {"range": BODY_HEAD_CELL_TMPL.format(row=row_idx), "values": [[f"本文取得エラー: {e}"]]}
+            )
+
+# 取得した本文・エラーをまとめて1回のAPIコールで書き込み
+if body_updates:
+    SHEETS_LIMITER.acquire()
+    sheet.batch_update(body_updates, value_input_option="USER_ENTERED")
+
+# 本文がシートへ反映できた時点でチェックポイントは役目を終える。
+# 残すと次回実行で古い本文を再利用しかねないため破棄する
+clear_checkpoint()
+
+# ============================
+#      コメント数の取得処理
+# ============================
+
+# コメント数取得とGemini解析は独立したI/Oなので、ここでは一括APIを
+# 投入だけしてGemini解析と並走させる。回収とO列書き込みは解析フェーズの後
+comment_batch_future = EXECUTOR.submit(
+    fetch_comment_counts_batch, [row_url for _row_idx, row_url in valid_rows]
+)
+
+# ============================
+#      Gemini による解析（並列）
+# ============================
+
+# Gemini呼び出しはサーバ側のモデル待ち時間が支配的なので、
+# レートリミッタの範囲内で複数バッチを同時に飛ばす
+gemini_results = {}
+
+# P〜R列の書き込みは行ごとに送らず、解析完了後に1回のbatch_updateで送る
+pending_updates = []
+
+with ThreadPoolExecutor(max_workers=GEMINI_WORKERS) as gemini_pool:
+    future_to_idx = {}
+    for row_idx, text in analysis_targets:
+        # 本文が短すぎる行（取得失敗・ペイウォール）はAPIを呼ばず空結果にする
+        if len(text.strip()) < MIN_AI_TEXT_CHARS:
+            gemini_results[row_idx] = {}
             continue
+        future_to_idx[gemini_pool.submit(analyze_with_gemini_limited, text)] = row_idx
 
-    else:
-        # 既に本文あり → 再取得しない
-        existing_text = sheet.acell(f"E{idx}").value
-        full_text_for_ai = existing_text if existing_text else ""
+    for future in as_completed(future_to_idx):
+        row_idx = future_to_idx[future]
+        try:
+            gemini_results[row_idx] = future.result()
+        except Exception as e:
+            print(f"[ERROR] Gemini解析失敗 (row {row_idx}): {e}")
+            pending_updates.append(
+                {"range": AI_HEAD_CELL_TMPL.format(row=row_idx), "values": [[f"AIエラー: {e}"]]}
+            )
 
-    # ============================
-    #      コメント数の取得処理
-    # ============================
+# 結果を行順にバッファへ積む
+for row_idx in sorted(gemini_results):
+    ai_result = gemini_results[row_idx]
 
-    try:
-        comment_count = fetch_comment_count(driver, url)
-        sheet.update(f"O{idx}", [[comment_count]])
-    except Exception as e:
-        print(f"[WARN] コメント数取得失敗: {e}")
-        sheet.update(f"O{idx}", [[f"Error: {e}"]])
+    # 結果の分解
+    category = ai_result.get("category", "")
+    sentiment = ai_result.get("sentiment", "")
+    company_info = ai_result.get("company_info", "")
 
-    # ============================
-    #      Gemini による解析
-    # ============================
+    pending_updates.append(
+        {
+            "range": AI_RANGE_TMPL.format(row=row_idx),
+            "values": [[sentiment, category, company_info]],
+        }
+    )
 
-    try:
-        ai_result = analyze_with_gemini(full_text_for_ai)
+# 解析結果をまとめて1回のAPIコールで書き込み
+if pending_updates:
+    SHEETS_LIMITER.acquire()
+    sheet.batch_update(pending_updates, value_input_option="USER_ENTERED")
+
+# ============================
+#      コメント数の回収と書き込み
+# ============================
+
+comment_updates = []
 
-        # 結果の分解
-        category = ai_result.get("category", "")
-        sentiment = ai_result.get("sentiment", "")
-        company_info = ai_result.get("company_info", "")
+try:
+    batch_counts = comment_batch_future.result()
+except Exception as e:
+    print(f"[WARN] コメント数一括取得失敗: {e}")
+    batch_counts = {}
 
-        # スプレッドシートに書き込み
-        sheet.update(f"P{idx}", [[sentiment]])
-        sheet.update(f"Q{idx}", [[category]])
-        sheet.update(f"R{idx}", [[company_info]])
+# 一括APIで取れた行はそのまま積み、漏れた行だけ行単位で並列取得する
+fallback_futures = {}
+for row_idx, row_url in valid_rows:
+    if row_url in batch_counts:
+        comment_updates.append(
+            {"range": COMMENT_CELL_TMPL.format(row=row_idx), "values": [[batch_counts[row_url]]]}
+        )
+    else:
+        fallback_futures[EXECUTOR.submit(fetch_comment_count, row_url)] = row_idx
 
+for future in as_completed(fallback_futures):
+    row_idx = fallback_futures[future]
+    try:
+        comment_count = future.result()
+        comment_updates.append(
+            {"range": COMMENT_CELL_TMPL.format(row=row_idx), "values": [[comment_count]]}
+        )
     except Exception as e:
-        print(f"[ERROR] Gemini解析失敗: {e}")
-        sheet.update(f"P{idx}", [[f"AIエラー: {e}"]])
+        print(f"[WARN] コメント数取得失敗: {e}")
+        comment_updates.append(
+            {"range": COMMENT_CELL_TMPL.format(row=row_idx), "values": [[f"Error: {e}"]]}
+        )
+
+# O列もフェーズ完了後に1回のbatch_updateで書き込み
+if comment_updates:
+    SHEETS_LIMITER.acquire()
+    sheet.batch_update(comment_updates, value_input_option="USER_ENTERED")